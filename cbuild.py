@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
 import json
+import hashlib
+import mmap
+import contextlib
+import shlex
+import functools
+from collections import deque
 
 import dataclasses
 from dataclasses import dataclass, field
-import copy
 
 import subprocess as sp
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # Config
 
@@ -39,6 +47,15 @@ CONFIG = Config(**config_json)
 
 # End of Config
 
+_CBUILD_CACHE_FILENAME = ".cbuild-cache.json"
+_CBUILD_CACHE_VERSION = 3
+
+_SOURCE_EXTENSIONS = (".c",)
+
+_LINK_MANIFEST_FILENAME = ".link-manifest.json"
+_OBJECTS_RESPONSE_FILENAME = "objects.rsp"
+_RESPONSE_FILE_THRESHOLD = 1000
+
 
 def usage():
     print()
@@ -60,9 +77,10 @@ def main():
         build(CONFIG)
     elif sys.argv[1] == "run":
         if build(CONFIG):
-            run(os.path.join(CONFIG.build_dir, CONFIG.binary))
+            binary = os.path.join(CONFIG.build_dir, CONFIG.binary)
+            run([binary], cwd=CONFIG.project_root)
     elif sys.argv[1] == "clean":
-        run(f"rm -rf {CONFIG.build_dir}")
+        run_shell(f"rm -rf {CONFIG.build_dir}", cwd=CONFIG.project_root)
     elif sys.argv[1] == "config":
         print_config(config=CONFIG, config_loaded=config_loaded)
     else:
@@ -70,9 +88,11 @@ def main():
 
 
 def build(config: Config):
-    config = copy.deepcopy(config)
+    config = dataclasses.replace(config, ignore_dirs=list(config.ignore_dirs))
+    _realpath.cache_clear()
+    _list_dir.cache_clear()
 
-    os.chdir(config.project_root)
+    root = config.project_root
     if config.build_dir not in config.ignore_dirs:
         config.ignore_dirs.append(config.build_dir)
 
@@ -94,112 +114,403 @@ def build(config: Config):
     config.cflags = config.cflags + " " + " ".join(dependencies_cflags)
     config.ldflags = config.ldflags + " " + " ".join(dependencies_ldflags)
 
-    cflags_iter = iter(config.cflags.split())
-    include_dirs = []
-    for flag in cflags_iter:
-        if flag == "-I":
-            try:
-                include_dirs.append(next(cflags_iter))
-            except StopIteration:
-                print("Expected a directory after -I: ", config.cflags)
-                exit(-1)
-        elif flag.startswith("-I"):
-            include_dir = flag[2:].strip()
-            include_dirs.append(include_dir)
-
-    c_files = list(
-        get_files_recursively(
-            ".",
-            dirs_filter=lambda d: d not in config.ignore_dirs,
-            files_filter=lambda f: f.endswith(".c"),
-        )
-    )
-    dependencies = {}
-    collect_dependencies(config.project_root, include_dirs, dependencies, c_files)
+    cc = split_flags("cc", config.cc)
+    cflags = split_flags("cflags", config.cflags)
+    ldflags = split_flags("ldflags", config.ldflags)
+    if cflags and cflags[-1] == "-I":
+        print("Expected a directory after -I: ", config.cflags)
+        exit(-1)
+    include_dirs = [
+        cflags[i + 1] if flag == "-I" else flag[2:]
+        for i, flag in enumerate(cflags)
+        if flag.startswith("-I")
+    ]
+
+    stat_memo = {}
+
+    c_files = []
+    for file, file_stat in get_files_recursively(
+        root,
+        dirs_filter=lambda d: d not in config.ignore_dirs,
+        files_filter=lambda f: f.endswith(_SOURCE_EXTENSIONS),
+    ):
+        c_files.append(file)
+        stat_memo[file] = file_stat
 
     if len(c_files) == 0:
         print("No files to compile.")
         return
 
-    object_files = []
-
-    mtime_memo = {}
-
-    any_compiled = False
-    for file in c_files:
-        file_stat = os.stat(file)
-        file_mtime = file_stat.st_mtime
-
-        object_file_name = file[:-2] + ".o"
-        object_file = os.path.join(config.build_dir, object_file_name)
-        object_files.append(object_file)
-
+    build_dir = os.path.join(root, config.build_dir)
+    cache = load_cache(build_dir)
+    new_cache = {}
+    dependencies = {}
+    collect_dependencies(
+        root,
+        include_dirs,
+        dependencies,
+        c_files,
+        stat_memo,
+        cache,
+        new_cache,
+    )
+    save_cache(build_dir, new_cache)
+
+    object_files = {
+        file: os.path.join(config.build_dir, os.path.splitext(file)[0] + ".o")
+        for file in c_files
+    }
+    object_mtimes = {}
+    for object_file in object_files.values():
         try:
-            object_stat = os.stat(object_file)
-            object_mtime = object_stat.st_mtime
+            object_mtime = os.stat(os.path.join(root, object_file)).st_mtime
+            object_mtimes[object_file] = object_mtime
         except FileNotFoundError:
-            object_mtime = 0
-
-        should_recompile = False
-        if file_mtime > object_mtime:
-            should_recompile = True
-        else:
-            should_recompile = any_dep_changed(
-                dependencies, file, object_mtime, mtime_memo
-            )
-
-        if should_recompile:
-            if not any_compiled:
-                print("Compiling ..")
-            any_compiled = True
-            object_file_dir = os.path.dirname(object_file)
-            os.makedirs(object_file_dir, exist_ok=True)
-            cmd = f"{config.cc} {config.cflags} -c {file} -o {object_file}"
-            run(cmd)
+            object_mtimes[object_file] = 0
+
+    content_mtimes = {file: entry["content_mtime"] for file, entry in new_cache.items()}
+    newest_mtimes = get_newest_mtimes(dependencies, content_mtimes)
+
+    compile_groups = []
+    object_file_dirs = set()
+    for group in topo_groups(c_files, dependencies):
+        compile_cmds = []
+        for file in group:
+            object_file = object_files[file]
+            if newest_mtimes[file] > object_mtimes[object_file]:
+                object_file_dirs.add(os.path.dirname(object_file))
+                cmd = [*cc, *cflags, "-c", file, "-o", object_file]
+                compile_cmds.append(cmd)
+        if compile_cmds:
+            compile_groups.append(compile_cmds)
+
+    any_compiled = len(compile_groups) > 0
+    if any_compiled:
+        print("Compiling ..")
+        for object_file_dir in object_file_dirs:
+            os.makedirs(os.path.join(root, object_file_dir), exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for compile_cmds in compile_groups:
+                jobs = [executor.submit(run, cmd, cwd=root) for cmd in compile_cmds]
+                # Wait for the whole group before surfacing a failure.
+                wait(jobs)
+                for job in jobs:
+                    job.result()
 
     binary = os.path.join(config.build_dir, config.binary)
-    if (not os.path.exists(binary)) or any_compiled:
+    link_command = [*cc, *ldflags, "-o", binary]
+    manifest_path = os.path.join(build_dir, _LINK_MANIFEST_FILENAME)
+    old_manifest = load_link_manifest(manifest_path)
+    objects = get_object_hashes(root, object_files.values(), old_manifest["objects"])
+    manifest = {"command": link_command, "objects": objects}
+
+    if (
+        (not os.path.exists(os.path.join(root, binary)))
+        or old_manifest["command"] != link_command
+        or get_link_inputs(old_manifest["objects"]) != get_link_inputs(objects)
+    ):
         print("Linking ..")
-        object_files_list = " ".join(str(f) for f in object_files)
-        run(f"{config.cc} {config.ldflags} {object_files_list} -o {binary}")
+        object_args = list(object_files.values())
+        if len(object_args) > _RESPONSE_FILE_THRESHOLD:
+            # Keep the command line short of ARG_MAX on large projects.
+            response_file = os.path.join(config.build_dir, _OBJECTS_RESPONSE_FILENAME)
+            content = " ".join(shlex.quote(arg) for arg in object_args)
+            write_if_changed(os.path.join(root, response_file), content)
+            object_args = ["@" + response_file]
+        run([*cc, *ldflags, *object_args, "-o", binary], cwd=root)
+        save_link_manifest(manifest_path, manifest)
     else:
+        if objects != old_manifest["objects"]:
+            # Record new sizes and mtimes so unchanged hashes aren't recomputed.
+            save_link_manifest(manifest_path, manifest)
         print("All up-to-date")
     return True
 
 
-def any_dep_changed(dependencies, file, object_mtime, mtime_memo):
-    for dep in dependencies[file]:
-        if dep in mtime_memo:
-            dep_mtime = mtime_memo[dep]
+def split_flags(name, flags):
+    try:
+        return shlex.split(flags)
+    except ValueError as e:
+        print(f"Can't parse {name} ({e}): ", flags)
+        exit(-1)
+
+
+def get_object_hashes(project_root, object_files, old_objects):
+    """
+    Return [path, size, mtime_ns, sha256] for each object file.
+
+    Objects whose size and mtime match `old_objects` reuse the recorded hash,
+    so only freshly compiled objects are read.
+    """
+    old_entries = {obj[0]: obj for obj in old_objects}
+    objects = []
+    for object_file in object_files:
+        path = os.path.join(project_root, object_file)
+        stat = os.stat(path)
+        old = old_entries.get(object_file)
+        if old is not None and old[1:3] == [stat.st_size, stat.st_mtime_ns]:
+            digest = old[3]
         else:
-            dep_stat = os.stat(dep)
-            dep_mtime = dep_stat.st_mtime
-            mtime_memo[dep] = dep_mtime
+            with open_file_data(path) as data:
+                digest = hashlib.sha256(data).hexdigest()
+        objects.append([object_file, stat.st_size, stat.st_mtime_ns, digest])
+    return objects
+
+
+def get_link_inputs(objects):
+    """
+    Reduce manifest entries to (path, sha256), ignoring size and mtime.
+    """
+    return [(obj[0], obj[3]) for obj in objects]
+
+
+def load_link_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"command": None, "objects": []}
 
-        if dep_mtime > object_mtime:
-            return True
-        if any_dep_changed(dependencies, dep, object_mtime, mtime_memo):
-            return True
-    return False
 
+def save_link_manifest(path, manifest):
+    with open(path, "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
 
-def collect_dependencies(project_root, include_dirs, dependencies, files):
+
+def write_if_changed(path, content):
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return
+    except FileNotFoundError:
+        pass
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def topo_groups(c_files, dependencies):
+    """
+    Split `c_files` into groups that can be compiled in parallel (Kahn's algorithm).
+
+    A .c file that includes another .c file, directly or through headers, goes into
+    a later group than the file it includes. Usually no .c file is included anywhere,
+    and everything ends up in a single group. Files that include each other in a
+    cycle can't be ordered and end up together in the last group.
+    """
+    c_file_set = set(c_files)
+    if not any(dep in c_file_set for deps in dependencies.values() for dep in deps):
+        return [list(c_files)]
+
+    dependents = {file: [] for file in c_files}
+    in_degree = dict.fromkeys(c_files, 0)
+    for file in c_files:
+        pending = list(dependencies[file])
+        visited = set()
+        while pending:
+            dep = pending.pop()
+            if dep in visited:
+                continue
+            visited.add(dep)
+            if dep in c_file_set and dep != file:
+                dependents[dep].append(file)
+                in_degree[file] += 1
+            pending.extend(dependencies[dep])
+
+    groups = []
+    ready = deque(file for file in c_files if in_degree[file] == 0)
+    while ready:
+        group = list(ready)
+        ready.clear()
+        for file in group:
+            for dependent in dependents[file]:
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    ready.append(dependent)
+        groups.append(group)
+
+    cyclic = [file for file in c_files if in_degree[file] > 0]
+    if cyclic:
+        groups.append(cyclic)
+    return groups
+
+
+def get_newest_mtimes(dependencies, mtimes):
+    """
+    For every file in `dependencies`, find the newest mtime among the file itself
+    and everything it transitively includes.
+
+    Files that include each other form a strongly connected component and share the
+    same result. Components are found with an iterative Tarjan's algorithm, which
+    finishes them in post-order, so each file's includes are resolved before it.
+    """
+    newest = {}
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+
+    for root in dependencies:
+        if root in index:
+            continue
+
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(dependencies[root]))]
+        while work:
+            file, deps = work[-1]
+            for dep in deps:
+                if dep not in index:
+                    index[dep] = lowlink[dep] = len(index)
+                    stack.append(dep)
+                    on_stack.add(dep)
+                    work.append((dep, iter(dependencies[dep])))
+                    break
+                if dep in on_stack:
+                    lowlink[file] = min(lowlink[file], index[dep])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[file])
+                if lowlink[file] != index[file]:
+                    continue
+
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member)
+                    component.append(member)
+                    if member == file:
+                        break
+
+                mtime = max(mtimes[member] for member in component)
+                for member in component:
+                    for dep in dependencies[member]:
+                        if dep in newest:
+                            mtime = max(mtime, newest[dep])
+                for member in component:
+                    newest[member] = mtime
+
+    return newest
+
+
+def get_stat(project_root, file, stat_memo):
+    """
+    Return the stat of `file`, calling `os.stat` at most once per file per build.
+    """
+    stat = stat_memo.get(file)
+    if stat is None:
+        stat = os.stat(os.path.join(project_root, file))
+        stat_memo[file] = stat
+    return stat
+
+
+def collect_dependencies(
+    project_root,
+    include_dirs,
+    dependencies,
+    files,
+    stat_memo,
+    cache,
+    new_cache,
+):
     """
     Find dependencies of each file in `files`, store them in dependencies.
-    Recursively store their dependencies as well.
+    Transitively store their dependencies as well.
+
+    Each file is scanned once, so headers that include each other don't cause a loop.
+
+    Files whose mtime (in ns) and size match the entry in `cache` are not read again.
+    Files whose mtime or size changed but whose content hashes the same keep their old
+    `content_mtime`, so touching a file without editing it doesn't trigger a rebuild.
+    Every visited file gets an up-to-date entry in `new_cache`.
     """
-    for file in files:
+    pending = deque(files)
+    while pending:
+        file = pending.popleft()
         if file in dependencies:
             continue
 
-        with open(file) as fp:
-            includes = get_includes(fp)
+        stat = get_stat(project_root, file, stat_memo)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        entry = cache.get(file)
+        if entry is not None and entry["stamp"] == stamp:
+            new_cache[file] = entry
+        else:
+            with open_file_data(os.path.join(project_root, file)) as data:
+                digest = hashlib.sha256(data).hexdigest()
+                if entry is not None and entry["hash"] == digest:
+                    new_cache[file] = dict(entry, stamp=stamp)
+                else:
+                    new_cache[file] = {
+                        "stamp": stamp,
+                        "content_mtime": stat.st_mtime,
+                        "hash": digest,
+                        "includes": get_includes(data),
+                    }
+        includes = [tuple(include) for include in new_cache[file]["includes"]]
 
         include_paths = resolve_include_paths(
             project_root, file, includes, include_dirs
         )
         dependencies[file] = include_paths
-        collect_dependencies(project_root, include_dirs, dependencies, include_paths)
+        pending.extend(include_paths)
+
+
+def load_cache(build_dir):
+    """
+    Load the per-file cache written by `save_cache`.
+    A missing, unreadable or outdated cache is treated as empty.
+    """
+    try:
+        with open(os.path.join(build_dir, _CBUILD_CACHE_FILENAME)) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != _CBUILD_CACHE_VERSION:
+        return {}
+    return cache["files"]
+
+
+def save_cache(build_dir, files):
+    os.makedirs(build_dir, exist_ok=True)
+    cache = {"version": _CBUILD_CACHE_VERSION, "files": files}
+    with open(os.path.join(build_dir, _CBUILD_CACHE_FILENAME), "w") as f:
+        json.dump(cache, f, separators=(",", ":"))
+
+
+@functools.lru_cache(maxsize=4096)
+def _realpath(path):
+    return os.path.realpath(path)
+
+
+@functools.lru_cache(maxsize=4096)
+def _list_dir(path):
+    """
+    Map the names in directory `path` to their `os.DirEntry`.
+    A directory that can't be listed is treated as empty.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry for entry in entries}
+    except OSError:
+        return {}
+
+
+def _isfile(path):
+    """
+    Like `os.path.isfile`, but a hit in the cached listing of the parent directory
+    answers without a syscall, so probing many headers in one directory costs one
+    `scandir`. A miss falls back to `os.path.isfile`, which still handles
+    case-insensitive filesystems and directories that can't be listed.
+    """
+    directory, name = os.path.split(path)
+    entry = _list_dir(directory or ".").get(name)
+    if entry is not None and entry.is_file():
+        return True
+    return os.path.isfile(path)
 
 
 def resolve_include_paths(
@@ -210,6 +521,7 @@ def resolve_include_paths(
 ):
     """
     Given a list of (include_type, include), return those in the project folder.
+    `file`, `include_dirs` and the returned paths are relative to `project_root`.
 
     We don't mind if an include referenced by a file is not found.
 
@@ -219,54 +531,78 @@ def resolve_include_paths(
     If it's a standard header, we don't have to track the changes to them.
     """
 
-    project_root = os.path.realpath(project_root)
+    project_root = _realpath(project_root)
+    prefix = os.path.join(project_root, "")
     file_dir = os.path.dirname(file)
 
     local_includes = []
     for include_type, include in includes:
         if include_type == "quote":
-            include_path = os.path.join(file_dir, include)
-            if os.path.isfile(include_path):
-                include_path = os.path.realpath(include_path)
-                if include_path.startswith(project_root + "/"):
-                    relative_path = include_path[len(project_root) + 1 :]
+            include_path = os.path.join(project_root, file_dir, include)
+            if _isfile(include_path):
+                include_path = _realpath(include_path)
+                if include_path.startswith(prefix):
+                    relative_path = include_path[len(prefix) :]
                     local_includes.append(relative_path)
                     continue
 
         for include_dir in include_dirs:
-            include_path = os.path.join(include_dir, include)
-            if os.path.exists(include_path):
-                include_path = os.path.realpath(include_path)
-                if include_path.startswith(project_root + "/"):
-                    relative_path = include_path[len(project_root) + 1 :]
+            include_path = os.path.join(project_root, include_dir, include)
+            if _isfile(include_path):
+                include_path = _realpath(include_path)
+                if include_path.startswith(prefix):
+                    relative_path = include_path[len(prefix) :]
                     local_includes.append(relative_path)
                     break
 
     return local_includes
 
 
-def get_files_recursively(root, dirs_filter, files_filter):
-    for dirpath, dirnames, filenames in os.walk(root):
-        dirnames[:] = [
-            d
-            for d in dirnames
-            if dirs_filter(os.path.normpath(os.path.join(dirpath, d)))
-        ]
-        dirpath = os.path.normpath(dirpath)
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
-            filepath = os.path.normpath(filepath)
-            if files_filter(filepath):
-                yield filepath
+def get_files_recursively(root, dirs_filter, files_filter, subdir=""):
+    """
+    Yield (path, stat) for every file under `root` accepted by `files_filter`.
+    Paths are relative to `root`.
+
+    The stat comes from the `os.DirEntry`, so callers don't need to stat the file again.
+    Like `os.walk`, symlinks to directories are not followed and directories that
+    can't be listed are skipped.
+    """
+    subdirs = []
+    try:
+        entries = os.scandir(os.path.join(root, subdir))
+    except OSError:
+        # Like `os.walk`, skip directories that can't be listed.
+        return
+    with entries:
+        for entry in entries:
+            path = os.path.join(subdir, entry.name)
+            if entry.is_dir():
+                if not entry.is_symlink() and dirs_filter(path):
+                    subdirs.append(path)
+            elif files_filter(path):
+                yield path, entry.stat()
+
+    for path in subdirs:
+        yield from get_files_recursively(root, dirs_filter, files_filter, path)
 
 
 def filter_subdirs(root, dirs, ignore: list[str]):
     dirs[:] = [d for d in dirs if str(root / d) not in ignore]
 
 
-def get_includes(file):
+_INCLUDE_RE = re.compile(
+    rb'^\s*#\s*include\s*(?:"([^"\n]+)"|<([^>\n]+)>)', re.MULTILINE
+)
+
+_BLANKS_AND_COMMENTS_RE = re.compile(rb"(?:\s+|/\*.*?\*/|//[^\n]*)*", re.DOTALL)
+_INCLUDE_SCAN_LINES = 50
+
+_MMAP_THRESHOLD = 1 << 20
+
+
+def get_includes(data):
     """
-    Returns a list of (include_type, file).
+    Returns a list of (include_type, file) for the source text `data` (bytes or mmap).
 
     For example:
     ```
@@ -277,35 +613,100 @@ def get_includes(file):
     becomes:
 
     [("quote", "foo.h"), ("angle_bracket", "bar.h")]
+
+    Includes are expected near the top of the file. Scanning stops once
+    `_INCLUDE_SCAN_LINES` lines of code (not counting blank lines and comments)
+    follow the last include without another one.
     """
     includes = []
-    for line in file:
-        line = line.strip()
-        if line.startswith("#include"):
-            line = line[len("#include") :].strip()
-            if line[0] == '"':
-                include_type = "quote"
-                open_bracket = 0
-                close_bracket = line.find('"', open_bracket + 1)
-            elif line[0] == "<":
-                include_type = "angle_bracket"
-                open_bracket = 0
-                close_bracket = line.find(">", open_bracket + 1)
-            else:
-                continue
-            if close_bracket == -1:
-                continue
-
-            include = line[open_bracket + 1 : close_bracket]
-            includes.append((include_type, include))
+    pos = 0
+    end = _skip_code_lines(data, pos, _INCLUDE_SCAN_LINES)
+    while True:
+        match = _INCLUDE_RE.search(data, pos, end)
+        if match is None:
+            break
+        quote, angle = match.groups()
+        if quote:
+            includes.append(("quote", os.fsdecode(quote)))
+        else:
+            includes.append(("angle_bracket", os.fsdecode(angle)))
+        pos = match.end()
+        end = _skip_code_lines(data, pos, _INCLUDE_SCAN_LINES)
     return includes
 
 
-def run(cmd: str):
-    print(">", cmd)
-    ret = os.system(cmd)
+def _skip_code_lines(data, pos, count):
+    """
+    Return the offset just past `count` lines of code following `pos`.
+    Blank lines and comments in between are skipped without being counted.
+    """
+    for _ in range(count):
+        pos = _BLANKS_AND_COMMENTS_RE.match(data, pos).end()
+        pos = data.find(b"\n", pos)
+        if pos == -1:
+            return len(data)
+        pos += 1
+    return pos
+
+
+@contextlib.contextmanager
+def open_file_data(path):
+    """
+    Yield the whole content of the file at `path` as a bytes-like object.
+
+    Files of at least `_MMAP_THRESHOLD` bytes are memory-mapped instead of copied,
+    so scanning large generated sources doesn't allocate a second copy of them.
+    Smaller files take one `fstat` to size the buffer, then a single `read` in
+    the common case.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size >= _MMAP_THRESHOLD:
+            with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as data:
+                yield data
+        else:
+            yield read_fd(fd, size)
+    finally:
+        os.close(fd)
+
+
+def read_fd(fd, size):
+    data = os.read(fd, size)
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+_print_lock = threading.Lock()
+
+
+def run(argv: list[str], cwd=None):
+    with _print_lock:
+        print(">", shlex.join(argv))
+    try:
+        ret = sp.run(argv, cwd=cwd, check=False).returncode
+    except OSError as e:
+        with _print_lock:
+            print("Can't run command:", e)
+        exit(-1)
+    exit_on_failure(ret)
+
+
+def run_shell(cmd: str, cwd=None):
+    with _print_lock:
+        print(">", cmd)
+    ret = sp.run(cmd, shell=True, cwd=cwd, check=False).returncode
+    exit_on_failure(ret)
+
+
+def exit_on_failure(ret):
     if ret != 0:
-        print("Command exited with:", ret)
+        with _print_lock:
+            print("Command exited with:", ret)
         exit(-1)
 
 
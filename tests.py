@@ -1,7 +1,12 @@
 from collections import deque
+import functools
+import hashlib
+import itertools
+import mmap
 import unittest
 import cbuild
 import tempfile
+import time
 import os
 
 
@@ -10,11 +15,12 @@ class CBuildTests(unittest.TestCase):
         self.tmpdir = tempfile.TemporaryDirectory()
 
         self.runs = deque()
+        self.modifications = itertools.count()
         old_run = cbuild.run
 
-        def new_run(cmd):
+        def new_run(cmd, **kwargs):
             self._record_runs(cmd)
-            old_run(cmd)
+            old_run(cmd, **kwargs)
 
         cbuild.run = new_run
 
@@ -60,7 +66,7 @@ class CBuildTests(unittest.TestCase):
                 msg = "Reason: " + msg
             self.fail(msg)
 
-        top_exec = top.split()[0]
+        top_exec = top[0]
         self.assertEqual(
             top_exec,
             cmd_components[0],
@@ -78,13 +84,37 @@ class CBuildTests(unittest.TestCase):
         self.assertEqual(
             len(self.runs),
             0,
-            "Expected runs to be empty. Got [{}] instead".format(", ".join(self.runs)),
+            "Expected runs to be empty. Got {} instead".format(list(self.runs)),
         )
 
     def _touch(self, file):
         file = os.path.join(self.tmpdir.name, file)
         os.utime(file)
 
+    def _modify(self, file):
+        self._append(file, f"\nstatic int cbuild_test_{next(self.modifications)};\n")
+
+    def _append(self, file, text):
+        with open(os.path.join(self.tmpdir.name, file), "a") as f:
+            f.write(text)
+        self._make_newer_than_objects(file)
+
+    def _make_newer_than_objects(self, file):
+        # An edit can land in the same filesystem timestamp tick as the last
+        # compile. Wait for the clock to move on so the edit is seen as newer.
+        newest = 0
+        build_dir = os.path.join(self.tmpdir.name, "build")
+        for dirpath, _, filenames in os.walk(build_dir):
+            for filename in filenames:
+                if filename.endswith(".o"):
+                    mtime = os.stat(os.path.join(dirpath, filename)).st_mtime_ns
+                    newest = max(newest, mtime)
+
+        file = os.path.join(self.tmpdir.name, file)
+        while os.stat(file).st_mtime_ns <= newest:
+            time.sleep(0.001)
+            os.utime(file)
+
     def test_gcc_works(self):
         self._setup_files(
             {
@@ -101,10 +131,68 @@ class CBuildTests(unittest.TestCase):
             build_dir="build",
             binary="main",
         )
+        cwd = os.getcwd()
         cbuild.build(config)
+        self.assertEqual(os.getcwd(), cwd)
         self._assert_file_exists("build", "src", "bar", "baz.o")
         self._assert_file_exists("build", "main")
 
+    def test_relative_project_root(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    #include "bar.h"
+
+                    int main() {}
+                """,
+                "src/bar.h": "",
+            }
+        )
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(self.tmpdir.name))
+        try:
+            config = cbuild.Config(
+                project_root=os.path.basename(self.tmpdir.name),
+                cc="gcc",
+                build_dir="build",
+                binary="main",
+            )
+            cbuild.build(config)
+            self._assert_ran(["gcc", "src/foo.c"])
+            self._assert_ran(["gcc", "build/main"])
+            self._assert_file_exists("build", "main")
+
+            self._modify("src/bar.h")
+            cbuild.build(config)
+            self._assert_ran(["gcc", "src/foo.c"])
+            self._assert_ran(["gcc", "build/main"])
+            self.assertEqual(os.getcwd(), os.path.dirname(self.tmpdir.name))
+        finally:
+            os.chdir(cwd)
+
+    def test_cc_with_arguments(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    #ifndef FROM_CC
+                    #error "cc arguments were not passed"
+                    #endif
+
+                    int main() {}
+                """
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc -DFROM_CC=1",
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_ran(["gcc", "-DFROM_CC=1", "src/foo.c"])
+        self._assert_ran(["gcc", "-DFROM_CC=1", "build/main"])
+        self._assert_file_exists("build", "main")
+
     def test_include_dirs(self):
         self._setup_files(
             {
@@ -148,7 +236,7 @@ class CBuildTests(unittest.TestCase):
             "vendor/libb/lib.h",
             "vendor/libc/lib.h",
         ]:
-            self._touch(file)
+            self._modify(file)
             cbuild.build(config)
             self._assert_ran(["gcc", "src/foo.c"], file)
             self._assert_ran(["gcc", "build/main"], file)
@@ -179,12 +267,12 @@ class CBuildTests(unittest.TestCase):
         cbuild.build(config)
         self._assert_nothing_ran()
 
-        self._touch("src/bar.h")
+        self._modify("src/bar.h")
         cbuild.build(config)
         self._assert_ran(["gcc", "src/foo.c"])
         self._assert_ran(["gcc", "build/main"])
 
-        self._touch("src/unused.h")
+        self._modify("src/unused.h")
         cbuild.build(config)
         self._assert_nothing_ran()
 
@@ -216,11 +304,408 @@ class CBuildTests(unittest.TestCase):
         cbuild.build(config)
         self._assert_nothing_ran()
 
-        self._touch("src/baz.h")
+        self._modify("src/baz.h")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+    def test_include_cycle(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    #include "a.h"
+
+                    int main() {}
+                """,
+                "src/bar.c": """
+                    #include "b.h"
+
+                    int bar() { return 0; }
+                """,
+                "src/a.h": """
+                    #ifndef A_H
+                    #define A_H
+                    #include "b.h"
+                    #endif
+                """,
+                "src/b.h": """
+                    #ifndef B_H
+                    #define B_H
+                    #include "a.h"
+                    #include "c.h"
+                    #endif
+                """,
+                "src/c.h": "",
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_ran(["gcc"])
+        self._assert_ran(["gcc"])
+        self._assert_ran(["gcc", "build/src/foo.o", "build/src/bar.o", "build/main"])
+
+        cbuild.build(config)
+        self._assert_nothing_ran()
+
+        for file in ["src/a.h", "src/b.h", "src/c.h"]:
+            self._modify(file)
+            cbuild.build(config)
+            self._assert_ran(["gcc"], file)
+            self._assert_ran(["gcc"], file)
+            self._assert_ran(["gcc", "build/main"], file)
+
+    def test_include_after_long_comment(self):
+        license_text = "".join(f" * License line {i}\n" for i in range(100))
+        self._setup_files(
+            {
+                "src/foo.c": (
+                    "/*\n" + license_text + " */\n\n"
+                    '#include "bar.h"\n\n'
+                    "int main() {}\n"
+                ),
+                "src/bar.h": "",
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+        self._modify("src/bar.h")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+    def test_c_file_included_by_other_c_files(self):
+        self._setup_files(
+            {
+                "src/base.c": """
+                    #ifndef BASE_C
+                    #define BASE_C
+                    static int base(void) { return 0; }
+                    #endif
+                """,
+                "src/mid.h": """
+                    #include "base.c"
+                """,
+                "src/mid.c": """
+                    #include "mid.h"
+                """,
+                "src/top.c": """
+                    #include "mid.c"
+
+                    int main() { return base(); }
+                """,
+            }
+        )
+        dependencies = {
+            "src/top.c": ["src/mid.c"],
+            "src/mid.c": ["src/mid.h"],
+            "src/mid.h": ["src/base.c"],
+            "src/base.c": [],
+        }
+        self.assertEqual(
+            cbuild.topo_groups(["src/top.c", "src/mid.c", "src/base.c"], dependencies),
+            [["src/base.c"], ["src/mid.c"], ["src/top.c"]],
+        )
+
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/base.c"])
+        self._assert_ran(["gcc", "src/mid.c"])
+        self._assert_ran(["gcc", "src/top.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+    def test_c_files_including_each_other(self):
+        self._setup_files(
+            {
+                "src/main.c": """
+                    int main() {}
+                """,
+                "src/a.c": """
+                    #ifndef A_C
+                    #define A_C
+                    #include "b.c"
+                    static int a(void) { return 0; }
+                    #endif
+                """,
+                "src/b.c": """
+                    #ifndef B_C
+                    #define B_C
+                    #include "a.c"
+                    static int b(void) { return 1; }
+                    #endif
+                """,
+            }
+        )
+        dependencies = {
+            "src/a.c": ["src/b.c"],
+            "src/b.c": ["src/a.c"],
+            "src/main.c": [],
+        }
+        self.assertEqual(
+            cbuild.topo_groups(["src/a.c", "src/b.c", "src/main.c"], dependencies),
+            [["src/main.c"], ["src/a.c", "src/b.c"]],
+        )
+
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/main.c"])
+        cyclic = {self.runs.popleft()[2], self.runs.popleft()[2]}
+        self.assertEqual(cyclic, {"src/a.c", "src/b.c"})
+        self._assert_ran(["gcc", "build/main"])
+
+        self._modify("src/a.c")
+        cbuild.build(config)
+        cyclic = {self.runs.popleft()[2], self.runs.popleft()[2]}
+        self.assertEqual(cyclic, {"src/a.c", "src/b.c"})
+        self._assert_ran(["gcc", "build/main"])
+
+    def test_scan_memory_mapped_sources(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    #include "bar.h"
+
+                    int main() {}
+                """,
+                "src/bar.h": """
+                    #include "baz.h"
+                """,
+                "src/baz.h": "/* baz */",
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        old_threshold = cbuild._MMAP_THRESHOLD
+        cbuild._MMAP_THRESHOLD = 1
+        try:
+            with cbuild.open_file_data(
+                os.path.join(self.tmpdir.name, "src/foo.c")
+            ) as data:
+                self.assertIsInstance(data, mmap.mmap)
+
+            cbuild.build(config)
+            self._assert_ran(["gcc", "src/foo.c"])
+            self._assert_ran(["gcc", "build/main"])
+
+            self._touch("src/foo.c")
+            self._touch("src/baz.h")
+            cbuild.build(config)
+            self._assert_nothing_ran()
+
+            self._modify("src/baz.h")
+            cbuild.build(config)
+            self._assert_ran(["gcc", "src/foo.c"])
+            self._assert_ran(["gcc", "build/main"])
+        finally:
+            cbuild._MMAP_THRESHOLD = old_threshold
+
+    def test_include_after_scan_window_is_ignored(self):
+        code = "".join(f"int x{i};\n" for i in range(cbuild._INCLUDE_SCAN_LINES + 1))
+        self._setup_files(
+            {
+                "src/foo.c": (
+                    '#include "near.h"\n' + code + '#include "far.h"\n\n'
+                    "int main() {}\n"
+                ),
+                "src/near.h": "",
+                "src/far.h": "",
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+        self._modify("src/far.h")
+        cbuild.build(config)
+        self._assert_nothing_ran()
+
+        self._modify("src/near.h")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+    def test_dependency_cache(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    #include "bar.h"
+
+                    int main() {}
+                """,
+                "src/bar.h": "",
+                "src/baz.h": "",
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_file_exists("build", ".cbuild-cache.json")
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+        self._setup_files({"src/bar.h": '#include "baz.h"'})
+        self._make_newer_than_objects("src/bar.h")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        # baz.h is empty, so foo.o comes out identical and isn't relinked.
+        self._assert_nothing_ran()
+
+        self._modify("src/baz.h")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+    def test_dependency_cache_same_mtime(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    #include "bar.h"
+
+                    int main() {}
+                """,
+                "src/bar.h": "",
+                "src/baz.h": "",
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+        # Rewrite bar.h within the same timestamp tick as the previous scan.
+        bar_h = os.path.join(self.tmpdir.name, "src/bar.h")
+        stat = os.stat(bar_h)
+        self._setup_files({"src/bar.h": '#include "baz.h"'})
+        os.utime(bar_h, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        cbuild.build(config)
+        self._assert_nothing_ran()
+
+        self._modify("src/baz.h")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+    def test_touch_without_change(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    #include "bar.h"
+
+                    int main() {}
+                """,
+                "src/bar.h": "",
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+        self._touch("src/foo.c")
+        self._touch("src/bar.h")
+        cbuild.build(config)
+        self._assert_nothing_ran()
+
+        self._modify("src/bar.h")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+    def test_relink_only_when_objects_change(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    int main() {}
+                """,
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
         cbuild.build(config)
         self._assert_ran(["gcc", "src/foo.c"])
         self._assert_ran(["gcc", "build/main"])
 
+        self._append("src/foo.c", "/* comment */\n")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_nothing_ran()
+
+        # The skipped link still records the new object mtime,
+        # so the next no-op build doesn't hash anything again.
+        old_sha256 = hashlib.sha256
+        hashed = []
+
+        def sha256(data):
+            hashed.append(data)
+            return old_sha256(data)
+
+        hashlib.sha256 = sha256
+        try:
+            cbuild.build(config)
+        finally:
+            hashlib.sha256 = old_sha256
+        self._assert_nothing_ran()
+        self.assertEqual(len(hashed), 0)
+
+        self._modify("src/foo.c")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+        config.ldflags = "-s"
+        cbuild.build(config)
+        self._assert_ran(["gcc", "-s", "build/main"])
+
     def test_multiple_c_files(self):
         self._setup_files(
             {
@@ -247,16 +732,75 @@ class CBuildTests(unittest.TestCase):
         cbuild.build(config)
         self._assert_nothing_ran()
 
-        self._touch("src/foo.c")
+        self._modify("src/foo.c")
         cbuild.build(config)
         self._assert_ran(["gcc", "src/foo.c"])
         self._assert_ran(["gcc", "build/src/foo.o", "build/src/bar.o", "build/main"])
 
-        self._touch("src/bar.c")
+        self._modify("src/bar.c")
         cbuild.build(config)
         self._assert_ran(["gcc", "src/bar.c"])
         self._assert_ran(["gcc", "build/src/foo.o", "build/src/bar.o", "build/main"])
 
+    def test_link_with_response_file(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    int main() {}
+                """,
+                "src/bar.c": """
+                    int foo() {}
+                """,
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        old_threshold = cbuild._RESPONSE_FILE_THRESHOLD
+        cbuild._RESPONSE_FILE_THRESHOLD = 1
+        try:
+            cbuild.build(config)
+        finally:
+            cbuild._RESPONSE_FILE_THRESHOLD = old_threshold
+
+        self._assert_ran(["gcc"])
+        self._assert_ran(["gcc"])
+        self._assert_ran(["gcc", "@build/objects.rsp", "build/main"])
+        self._assert_file_exists("build", "objects.rsp")
+        self._assert_file_exists("build", "main")
+
+    def test_compile_failure(self):
+        self._setup_files(
+            {
+                "src/good.c": """
+                    int main() {}
+                """,
+                "src/broken.c": """
+                    int broken( {}
+                """,
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        with self.assertRaises(SystemExit) as cm:
+            cbuild.build(config)
+        self.assertEqual(cm.exception.code, -1)
+
+        compiled = {self.runs.popleft()[2], self.runs.popleft()[2]}
+        self.assertEqual(compiled, {"src/good.c", "src/broken.c"})
+        self._assert_nothing_ran()
+        self._assert_file_exists("build", "src", "good.o")
+        self.assertFalse(
+            os.path.exists(os.path.join(self.tmpdir.name, "build", "main"))
+        )
+
     def test_quoted_include_not_in_same_dir(self):
         self._setup_files(
             {
@@ -283,11 +827,130 @@ class CBuildTests(unittest.TestCase):
         cbuild.build(config)
         self._assert_nothing_ran()
 
-        self._touch("includes/lib.h")
+        self._modify("includes/lib.h")
         cbuild.build(config)
         self._assert_ran(["gcc", "src/foo.c"])
         self._assert_ran(["gcc", "build/src/foo.o", "build/main"])
 
+    def test_quoted_include_dir_with_spaces(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    #include <lib.h>
+
+                    int main() {}
+                """,
+                "my includes/lib.h": "",
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            cflags='-I "my includes"',
+            build_dir="build",
+            binary="main",
+        )
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c", "my includes"])
+        self._assert_ran(["gcc", "build/main"])
+
+        self._modify("my includes/lib.h")
+        cbuild.build(config)
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/main"])
+
+    def test_include_probe_falls_back_to_isfile(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    #include <lib.h>
+                    #include "bar.h"
+
+                    int main() {}
+                """,
+                "src/bar.h": "",
+                "includes/lib.h": "",
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            cflags="-Iincludes",
+            build_dir="build",
+            binary="main",
+        )
+        # Simulate listings that can't see the headers, e.g. a case-insensitive
+        # filesystem or a directory that can be searched but not read.
+        old_list_dir = cbuild._list_dir
+        cbuild._list_dir = functools.lru_cache(maxsize=None)(lambda path: {})
+        try:
+            cbuild.build(config)
+            self._assert_ran(["gcc", "src/foo.c"])
+            self._assert_ran(["gcc", "build/main"])
+
+            for file in ["includes/lib.h", "src/bar.h"]:
+                self._modify(file)
+                cbuild.build(config)
+                self._assert_ran(["gcc", "src/foo.c"], file)
+                self._assert_ran(["gcc", "build/main"], file)
+        finally:
+            cbuild._list_dir = old_list_dir
+
+    def test_unreadable_dir_is_skipped(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    int main() {}
+                """,
+                "locked/bar.c": """
+                    int bar() {}
+                """,
+            }
+        )
+        config = cbuild.Config(
+            project_root=self.tmpdir.name,
+            cc="gcc",
+            build_dir="build",
+            binary="main",
+        )
+        locked = os.path.join(self.tmpdir.name, "locked")
+        old_scandir = os.scandir
+
+        def scandir(path):
+            if os.path.normpath(path) == locked:
+                raise PermissionError(13, "Permission denied", path)
+            return old_scandir(path)
+
+        os.scandir = scandir
+        try:
+            cbuild.build(config)
+        finally:
+            os.scandir = old_scandir
+
+        self._assert_ran(["gcc", "src/foo.c"])
+        self._assert_ran(["gcc", "build/src/foo.o", "build/main"])
+        self._assert_nothing_ran()
+
+    def test_malformed_flags(self):
+        self._setup_files(
+            {
+                "src/foo.c": """
+                    int main() {}
+                """,
+            }
+        )
+        for field in ["cflags", "ldflags"]:
+            config = cbuild.Config(
+                project_root=self.tmpdir.name,
+                cc="gcc",
+                build_dir="build",
+                binary="main",
+                **{field: '-DX="a'},
+            )
+            with self.assertRaises(SystemExit, msg=field):
+                cbuild.build(config)
+            self._assert_nothing_ran()
+
     def test_ignore_dirs_work(self):
         self._setup_files(
             {